@@ -4,11 +4,91 @@ import re
 import subprocess
 from . import evaluate
 from collections import namedtuple
+from functools import cached_property
 from glob import glob
 import numpy as np
 
-Markable = namedtuple('Markable',
-                      ['string', 'entity', 'start_token', 'end_token', 'tags'])
+# POS tags of the "content words" compared by coref_rules.match_on_content
+CONTENT_TAGS = frozenset(
+    ['CD', 'NN', 'NNS', 'NNP', 'NNPS', 'PRP', 'PRP$', 'JJ', 'JJR', 'JJS'])
+
+# lowercased token -> integer ID, shared across documents so that the IDs of
+# any two markables can be compared
+_TOKEN_IDS = {}
+
+
+class Markable(
+        namedtuple('Markable',
+                   ['string', 'entity', 'start_token', 'end_token', 'tags'])):
+    """
+    A mention in a document. The lowercased views of the tokens are
+    computed once per markable and cached, since the pairwise matchers
+    compare them for every (antecedent, mention) pair. The matchers compare
+    the interned integer IDs of the lowercased tokens rather than the strings.
+    """
+
+    @cached_property
+    def lower_string(self):
+        return tuple(map(str.lower, self.string))
+
+    @cached_property
+    def token_ids(self):
+        return tuple(
+            _TOKEN_IDS.setdefault(tok, len(_TOKEN_IDS))
+            for tok in self.lower_string)
+
+    @cached_property
+    def content_token_ids(self):
+        return tuple(tok_id for tok_id, tag in zip(self.token_ids, self.tags)
+                     if tag in CONTENT_TAGS)
+
+
+# Parallel arrays describing all markables of a document, for vectorized
+# pairwise computations. The *_ids arrays hold small integer codes which are
+# equal exactly when the corresponding Markable attributes are equal.
+MarkableSet = namedtuple('MarkableSet', [
+    'starts', 'ends', 'entities', 'string_ids', 'last_ids', 'content_ids'
+])
+
+
+def _codes(keys):
+    codes = {}
+    return np.array([codes.setdefault(key, len(codes)) for key in keys],
+                    dtype=np.int32)
+
+
+def to_spans(markables):
+    """
+    Token offsets of a list of markables, the part of to_markable_set
+    needed by span-only computations
+
+    :param markables: list of markables in the document
+    :returns: arrays of start and end token offsets
+    :rtype: np.ndarray, np.ndarray
+    """
+    return (np.array([m.start_token for m in markables], dtype=np.int32),
+            np.array([m.end_token for m in markables], dtype=np.int32))
+
+
+def to_markable_set(markables):
+    """
+    Convert a list of markables into parallel arrays.
+    Build it once per document and pass it to the functions that accept one.
+
+    :param markables: list of markables in the document
+    :returns: arrays of offsets, entities and lowercased-token codes
+    :rtype: MarkableSet
+    """
+    starts, ends = to_spans(markables)
+    return MarkableSet(
+        starts=starts,
+        ends=ends,
+        entities=_codes(m.entity for m in markables),
+        string_ids=_codes(m.token_ids for m in markables),
+        last_ids=_codes(m.token_ids[-1] for m in markables),
+        content_ids=_codes(m.content_token_ids for m in markables))
+
+
 Document = namedtuple(
     'Document', ['clusters', 'gold', 'mention_to_gold', 'mention_to_cluster'])
 
@@ -1,39 +1,112 @@
-from . import coref_rules
+from . import coref, coref_rules
 from collections import defaultdict
+import numpy as np
 
+MINIMAL_FEATURES = [
+    'exact-match', 'last-token-match', 'content-match', 'crossover',
+    'new-entity'
+]
+MAX_MENTION_DISTANCE = 5
+MAX_TOKEN_DISTANCE = 10
+DISTANCE_FEATURES = \
+    [f'mention-distance-{d}' for d in range(1, MAX_MENTION_DISTANCE + 1)] + \
+    [f'token-distance-{d}' for d in range(1, MAX_TOKEN_DISTANCE + 1)]
 
-def minimal_features(markables, a, i):
+# every feature produced by the built-in feature functions, in a fixed order
+FEATURE_NAMES = MINIMAL_FEATURES + DISTANCE_FEATURES
+FEATURE_INDEX = {feat: i for i, feat in enumerate(FEATURE_NAMES)}
+
+# Feature sets are packed into a bitmask, with bit k set when feature
+# FEATURE_NAMES[k] fires.
+assert len(FEATURE_NAMES) <= 64, "feature masks are stored as uint64"
+
+_EXACT_MATCH = 1 << FEATURE_INDEX['exact-match']
+_LAST_TOKEN_MATCH = 1 << FEATURE_INDEX['last-token-match']
+_CONTENT_MATCH = 1 << FEATURE_INDEX['content-match']
+_CROSSOVER = 1 << FEATURE_INDEX['crossover']
+_NEW_ENTITY = 1 << FEATURE_INDEX['new-entity']
+_MENTION_DISTANCE_BASE = FEATURE_INDEX['mention-distance-1'] - 1
+_TOKEN_DISTANCE_BASE = FEATURE_INDEX['token-distance-1'] - 1
+
+
+def mask_to_ids(mask, feature_ids=None):
     """
-    Compute a minimal set of features for antecedent a and mention i
+    Unpack a feature bitmask
+
+    :param mask: feature bitmask
+    :param feature_ids: indices into FEATURE_NAMES in the order to list them, all of them in increasing order by default
+    :returns: indices into FEATURE_NAMES of the features that fire
+    :rtype: list
+    """
+    mask = int(mask)
+    if feature_ids is None:
+        feature_ids = range(len(FEATURE_NAMES))
+    return [idx for idx in feature_ids if mask >> idx & 1]
+
+
+def mask_to_features(mask, feature_ids=None):
+    """
+    Convert a feature bitmask into a feature dict
+
+    :param mask: feature bitmask
+    :param feature_ids: indices into FEATURE_NAMES in the order to insert them, all of them in increasing order by default
+    :returns: dict of features
+    :rtype: defaultdict
+    """
+    f = defaultdict(float)
+    for idx in mask_to_ids(mask, feature_ids):
+        f[FEATURE_NAMES[idx]] = 1
+    return f
+
+
+def minimal_feature_mask(markables, a, i):
+    """
+    Bitmask form of minimal_features
 
     :param markables: list of markables for the document
     :param a: index of antecedent
     :param i: index of mention
-    :returns: dict of features
-    :rtype: defaultdict
+    :returns: feature bitmask
+    :rtype: int
     """
 
-    f = defaultdict(float)
+    if a == i:
+        return _NEW_ENTITY
 
     m_a = markables[a]
     m_i = markables[i]
 
-    if a == i:
-        f["new-entity"] = 1
-    else:
-        if coref_rules.exact_match(m_a, m_i):
-            f["exact-match"] = 1
-        if coref_rules.match_last_token(m_a, m_i):
-            f["last-token-match"] = 1
-        if coref_rules.match_on_content(m_a, m_i):
-            f["content-match"] = 1
-        if m_a.start_token <= m_i.start_token <= m_a.end_token or m_i.start_token <= m_a.start_token <= m_i.end_token:
-            f["crossover"] = 1
+    mask = 0
+    if coref_rules.exact_match(m_a, m_i):
+        mask |= _EXACT_MATCH
+    if coref_rules.match_last_token(m_a, m_i):
+        mask |= _LAST_TOKEN_MATCH
+    if coref_rules.match_on_content(m_a, m_i):
+        mask |= _CONTENT_MATCH
+    if m_a.start_token <= m_i.start_token <= m_a.end_token or m_i.start_token <= m_a.start_token <= m_i.end_token:
+        mask |= _CROSSOVER
+    return mask
 
-    return f
+
+def minimal_features(markables, a, i):
+    """
+    Compute a minimal set of features for antecedent a and mention i
+
+    :param markables: list of markables for the document
+    :param a: index of antecedent
+    :param i: index of mention
+    :returns: dict of features
+    :rtype: defaultdict
+    """
+
+    return mask_to_features(minimal_feature_mask(markables, a, i))
 
 
-def distance_features(x, a, i, max_mention_distance=5, max_token_distance=10):
+def distance_features(x,
+                      a,
+                      i,
+                      max_mention_distance=MAX_MENTION_DISTANCE,
+                      max_token_distance=MAX_TOKEN_DISTANCE):
     """
     compute a set of distance features for antecedent a and mention i
 
@@ -61,6 +134,192 @@ def distance_features(x, a, i, max_mention_distance=5, max_token_distance=10):
         return f
 
 
+def distance_feature_matrices(x, mark_set=None):
+    """
+    Compute the distance feature indices of every pair in the document at once
+
+    :param x: markable list for document
+    :param mark_set: coref.to_markable_set of x, if already computed
+    :returns: MxM arrays of mention-distance and token-distance feature
+              indices, indexed [i, a], holding -1 where no feature fires
+    :rtype: np.ndarray, np.ndarray
+    """
+
+    if mark_set is None:
+        starts, ends = coref.to_spans(x)
+    else:
+        starts, ends = mark_set.starts, mark_set.ends
+    positions = np.arange(len(x))
+    mention_dist = np.minimum(
+        np.abs(positions[:, None] - positions[None, :]), MAX_MENTION_DISTANCE)
+    token_dist = np.minimum(np.abs(starts[:, None] - ends[None, :]),
+                            MAX_TOKEN_DISTANCE)
+
+    # mention_dist is zero exactly on the diagonal, i.e. when a == i
+    mention_ids = np.where(mention_dist > 0,
+                           _MENTION_DISTANCE_BASE + mention_dist, -1)
+    token_ids = np.where((mention_dist > 0) & (token_dist > 0),
+                         _TOKEN_DISTANCE_BASE + token_dist, -1)
+    return mention_ids, token_ids
+
+
+def minimal_feature_matrix(markables, mark_set=None):
+    """
+    Compute the minimal features of every pair in the document at once
+
+    :param markables: list of markables for the document
+    :param mark_set: coref.to_markable_set of markables, if already computed
+    :returns: MxMxK array indexed [i, a, k], True where feature
+              MINIMAL_FEATURES[k] fires for antecedent a and mention i
+    :rtype: np.ndarray
+    """
+
+    if mark_set is None:
+        mark_set = coref.to_markable_set(markables)
+    same = lambda ids: ids[:, None] == ids[None, :]
+    new_entity = np.eye(len(markables), dtype=bool)
+    overlap = coref_rules.span_overlap(mark_set.starts, mark_set.ends)
+
+    active = np.stack([
+        same(mark_set.string_ids),
+        same(mark_set.last_ids),
+        same(mark_set.content_ids) & ~overlap,
+        overlap,
+        new_entity,
+    ], axis=2)
+    # a markable paired with itself only fires new-entity
+    active[new_entity, :-1] = False
+    return active
+
+
+_MINIMAL_BITS = np.array([1 << FEATURE_INDEX[feat] for feat in MINIMAL_FEATURES],
+                         dtype=np.uint64)
+
+
+def _minimal_document_masks(markables, mark_set):
+    active = minimal_feature_matrix(markables, mark_set)
+    return np.bitwise_or.reduce(np.where(active, _MINIMAL_BITS, 0), axis=2)
+
+
+def _distance_document_masks(x, mark_set):
+    masks = np.zeros((len(x), len(x)), dtype=np.uint64)
+    for ids in distance_feature_matrices(x, mark_set):
+        masks |= np.where(ids >= 0, np.left_shift(1, ids.clip(min=0)),
+                          0).astype(np.uint64)
+    return masks
+
+
+def document_feature_masks(markables, feat_func, mark_set=None):
+    """
+    Compute the feature bitmasks of every pair in the document at once
+
+    :param markables: list of markables for the document
+    :param feat_func: feature function returning a dict of features
+    :param mark_set: coref.to_markable_set of markables, if already computed
+    :returns: MxM array of feature bitmasks indexed [i, a],
+              or None if feat_func has no bitmask form
+    :rtype: np.ndarray
+    """
+    doc_masks_func = getattr(feat_func, 'document_masks', None)
+    if doc_masks_func is None:
+        return None
+    if mark_set is None:
+        mark_set = coref.to_markable_set(markables)
+    return doc_masks_func(markables, mark_set).astype(np.uint64)
+
+
+_MENTION_DISTANCE_BITS = [0] + [
+    1 << (_MENTION_DISTANCE_BASE + d)
+    for d in range(1, MAX_MENTION_DISTANCE + 1)
+]
+_TOKEN_DISTANCE_BITS = [0] + [
+    1 << (_TOKEN_DISTANCE_BASE + d) for d in range(1, MAX_TOKEN_DISTANCE + 1)
+]
+
+# Feature functions with a bitmask form carry it as attributes:
+#   feature_ids: indices into FEATURE_NAMES of its features, in the order the
+#       function inserts them into its feature dict
+#   document_masks: function computing the MxM bitmasks of a whole document
+#       from its markables and their coref.to_markable_set
+#   mask_source: (bitmask when a == i, statements adding its features to
+#       `mask` for markables m_a and m_i), inlined by compile_feature_mask
+minimal_features.feature_ids = [FEATURE_INDEX[feat] for feat in MINIMAL_FEATURES]
+minimal_features.document_masks = _minimal_document_masks
+# The snippets inline minimal_feature_mask and distance_features; keep them in
+# sync with those and with the coref_rules matchers named below.
+minimal_features.mask_source = (_NEW_ENTITY, [
+    # the crossover test of minimal_feature_mask, and the negation of
+    # coref_rules.match_no_overlap
+    'overlap = m_a.start_token <= m_i.start_token <= m_a.end_token or '
+    'm_i.start_token <= m_a.start_token <= m_i.end_token',
+    # coref_rules.exact_match
+    'if m_a.token_ids == m_i.token_ids:',
+    '    mask |= _EXACT_MATCH',
+    # coref_rules.match_last_token
+    'if m_a.token_ids[-1] == m_i.token_ids[-1]:',
+    '    mask |= _LAST_TOKEN_MATCH',
+    'if overlap:',
+    '    mask |= _CROSSOVER',
+    # coref_rules.match_on_content, which fails on overlapping spans
+    'elif m_a.content_token_ids == m_i.content_token_ids:',
+    '    mask |= _CONTENT_MATCH',
+])
+
+distance_features.feature_ids = [
+    FEATURE_INDEX[feat] for feat in DISTANCE_FEATURES
+]
+distance_features.document_masks = _distance_document_masks
+# distance_features with its default limits
+distance_features.mask_source = (0, [
+    'mask |= _MENTION_DISTANCE_BITS[min(abs(i - a), MAX_MENTION_DISTANCE)]',
+    'mask |= _TOKEN_DISTANCE_BITS[min(abs(m_i.start_token - m_a.end_token), '
+    'MAX_TOKEN_DISTANCE)]',
+])
+
+
+def feature_order(feat_func):
+    """
+    :param feat_func: feature function returning a dict of features
+    :returns: indices into FEATURE_NAMES of the features of feat_func, in
+              the order it inserts them, or None if feat_func has no bitmask form
+    :rtype: list
+    """
+    return getattr(feat_func, 'feature_ids', None)
+
+
+def _union_mask_source(feat_func_list):
+    same_mask = 0
+    body = []
+    for feat_func in feat_func_list:
+        func_same_mask, func_body = feat_func.mask_source
+        same_mask |= func_same_mask
+        body += func_body
+    return same_mask, body
+
+
+def compile_feature_mask(feat_func_list):
+    """
+    Generate a single bitmask function for the union of the feature functions,
+    with the code of each one inlined
+
+    :param feat_func_list: list of feature functions with a mask_source
+    :returns: function from (markables, a, i) to a feature bitmask
+    :rtype: function
+    """
+    same_mask, body = _union_mask_source(feat_func_list)
+    source = '\n    '.join([
+        'def fused_feature_mask(x, a, i):',
+        'if a == i:',
+        f'    return {same_mask}',
+        'm_a = x[a]',
+        'm_i = x[i]',
+        'mask = 0',
+    ] + body + ['return mask'])
+    namespace = {}
+    exec(source, globals(), namespace)
+    return namespace['fused_feature_mask']
+
+
 def make_feature_union(feat_func_list):
     """
     return a feature function that is the union of the feature functions in the list
@@ -76,7 +335,29 @@ def make_feature_union(feat_func_list):
             f.update(feat_func(x, a, i))
         return f
 
-    return union_func
+    if not all(feature_order(feat_func) is not None
+               for feat_func in feat_func_list):
+        return union_func
+
+    # like dict.update, a feature keeps the position of its first insertion
+    feature_ids = list(
+        dict.fromkeys(idx for feat_func in feat_func_list
+                      for idx in feature_order(feat_func)))
+    fused_feature_mask = compile_feature_mask(feat_func_list)
+
+    def fused_union_func(x, a, i):
+        return mask_to_features(fused_feature_mask(x, a, i), feature_ids)
+
+    def union_document_masks(x, mark_set):
+        return np.bitwise_or.reduce([
+            document_feature_masks(x, feat_func, mark_set)
+            for feat_func in feat_func_list
+        ])
+
+    fused_union_func.feature_ids = feature_ids
+    fused_union_func.document_masks = union_document_masks
+    fused_union_func.mask_source = _union_mask_source(feat_func_list)
+    return fused_union_func
 
 
 def make_bakeoff_features():
@@ -4,13 +4,20 @@
 # http://nlp.stanford.edu/pubs/conllst2011-coref.pdf
 
 import nltk
+import numpy as np
 
-pronouns = ['i', 'me', 'mine', 'you', 'your', 'yours', 'she', 'her', 'hers'] + \
-           ['he', 'him', 'his', 'it', 'its', 'they', 'them', 'their', 'theirs'] + \
-           ['this', 'those', 'these', 'that', 'we', 'our', 'us', 'ours']
+from . import coref
+
+pronouns = frozenset(
+    ['i', 'me', 'mine', 'you', 'your', 'yours', 'she', 'her', 'hers'] +
+    ['he', 'him', 'his', 'it', 'its', 'they', 'them', 'their', 'theirs'] +
+    ['this', 'those', 'these', 'that', 'we', 'our', 'us', 'ours'])
 downcase_list = lambda toks: [tok.lower() for tok in toks]
 
 ############## Pairwise matchers #######################
+# exact_match, match_last_token and match_on_content are also vectorized in
+# coref_features.minimal_feature_matrix and inlined as source code in
+# coref_features.minimal_features.mask_source; change them together.
 
 
 def exact_match(m_a, m_i):
@@ -22,7 +29,7 @@ def exact_match(m_a, m_i):
     :returns: True if the strings are identical
     :rtype: boolean
     """
-    return downcase_list(m_a.string) == downcase_list(m_i.string)
+    return m_a.token_ids == m_i.token_ids
 
 
 def singleton_matcher(m_a, m_i):
@@ -65,8 +72,8 @@ def exact_match_no_pronouns(m_a, m_i):
     #     print("m_a:{}, m_i:{}, c1:{}, c2:{}".format(m_a, m_i, c1, c2))
     # print("m_a:{}, m_i:{}, c1:{}, c2:{}".format(m_a.string, m_i.string, c1, c2))
 
-    return downcase_list(m_a.string) == downcase_list(
-        m_i.string) and not ("".join(m_a.string).lower() in pronouns)
+    return m_a.token_ids == m_i.token_ids and \
+           not ("".join(m_a.lower_string) in pronouns)
 
 
 def match_last_token(m_a, m_i):
@@ -77,7 +84,7 @@ def match_last_token(m_a, m_i):
     :param m_i: referent markable
     :rtype: boolean
     """
-    return m_a.string[-1].lower() == m_i.string[-1].lower()
+    return m_a.token_ids[-1] == m_i.token_ids[-1]
 
 
 def match_no_overlap(m_a, m_i):
@@ -107,24 +114,53 @@ def match_on_content(m_a, m_i):
     :returns: True if all match on all "content words" (defined by POS tag) and markables do not overlap
     :rtype: boolean
     """
-    ALLOWED_TAGS = [
-        'CD', 'NN', 'NNS', 'NNP', 'NNPS', 'PRP', 'PRP$', 'JJ', 'JJR', 'JJS'
-    ]
-
-    filtered_ma_s = [
-        token for i, token in enumerate(m_a.string)
-        if m_a.tags[i] in ALLOWED_TAGS
-    ]
-    filtered_mi_s = [
-        token for i, token in enumerate(m_i.string)
-        if m_i.tags[i] in ALLOWED_TAGS
-    ]
-
     return not (m_i.start_token <= m_a.start_token <= m_i.end_token) and \
            not (m_a.start_token <= m_i.start_token <= m_a.end_token) and \
-           downcase_list(filtered_ma_s) == downcase_list(filtered_mi_s)
+           m_a.content_token_ids == m_i.content_token_ids
+
+
+############## Matching keys #######################
+# Matchers that are pure equivalence tests can be resolved by hashing a key
+# per markable. A key of None means the markable never matches.
+
+
+def exact_key(m):
+    return m.token_ids
+
+
+def last_token_key(m):
+    return m.token_ids[-1]
+
+
+def exact_no_pronoun_key(m):
+    return None if "".join(m.lower_string) in pronouns else m.token_ids
 
 
+def content_key(m):
+    return m.content_token_ids
+
+
+# matcher -> (key function, whether overlapping spans are excluded)
+_MATCHER_KEYS = {
+    exact_match: (exact_key, False),
+    match_last_token: (last_token_key, False),
+    exact_match_no_pronouns: (exact_no_pronoun_key, False),
+    match_last_token_no_overlap: (last_token_key, True),
+    match_on_content: (content_key, True),
+}
+
+############## Span matchers #######################
+# Matchers that only look at token offsets, computed for all pairs at once
+# from the start/end arrays. Each returns an MxM boolean matrix indexed [i, a].
+
+_SPAN_MATCHERS = {
+    match_no_overlap: lambda starts, ends: ~span_overlap(starts, ends),
+    singleton_matcher: lambda starts, ends:
+        (starts[:, None] == starts[None, :]) & (ends[:, None] == ends[None, :]),
+    full_cluster_matcher: lambda starts, ends:
+        np.ones((len(starts), len(starts)), dtype=bool),
+}
+
 ########## helper code
 
 
@@ -138,6 +174,13 @@ def most_recent_match(markables, matcher):
     :returns: list of antecedent indices
     :rtype: list
     """
+    if matcher in _MATCHER_KEYS:
+        key_fn, no_overlap = _MATCHER_KEYS[matcher]
+        return most_recent_match_by_key(markables, key_fn, no_overlap)
+    if matcher in _SPAN_MATCHERS:
+        return most_recent_compatible(_SPAN_MATCHERS[matcher](
+            *coref.to_spans(markables)))
+
     antecedents = list(range(len(markables)))
     for i, m_i in enumerate(markables):
         for a, m_a in enumerate(markables[:i]):
@@ -146,6 +189,64 @@ def most_recent_match(markables, matcher):
     return antecedents
 
 
+def most_recent_match_by_key(markables, key_fn, no_overlap=False):
+    """
+    single-pass equivalent of most_recent_match for matchers that compare keys
+
+    :param markables: list of markables
+    :param key_fn: function from markable to hashable key, or None if it never matches
+    :param no_overlap: if True, skip antecedents whose span overlaps the mention
+    :returns: list of antecedent indices
+    :rtype: list
+    """
+    antecedents = list(range(len(markables)))
+    if no_overlap:
+        overlap = span_overlap(*coref.to_spans(markables))
+    seen = {}
+    for i, m_i in enumerate(markables):
+        key = key_fn(m_i)
+        if key is None:
+            continue
+        bucket = seen.setdefault(key, [])
+        for a in reversed(bucket):
+            if not (no_overlap and overlap[i, a]):
+                antecedents[i] = a
+                break
+        bucket.append(i)
+    return antecedents
+
+
+def span_overlap(starts, ends):
+    """
+    vectorized form of the overlap test in match_no_overlap
+
+    :param starts: start token offsets of the markables
+    :param ends: end token offsets of the markables
+    :returns: MxM matrix, True where the spans of markables i and a overlap
+    :rtype: np.ndarray
+    """
+    starts_within = (starts[:, None] <= starts[None, :]) & \
+                    (starts[None, :] <= ends[:, None])
+    return starts_within | starts_within.T
+
+
+def most_recent_compatible(compatible):
+    """
+    pick the most recent compatible antecedent for every mention
+
+    :param compatible: MxM boolean matrix indexed [i, a]
+    :returns: list of antecedent indices
+    :rtype: list
+    """
+    n_marks = compatible.shape[0]
+    if n_marks == 0:
+        return []
+    candidates = np.tril(compatible, k=-1)
+    last = n_marks - 1 - np.argmax(candidates[:, ::-1], axis=1)
+    return np.where(candidates.any(axis=1), last,
+                    np.arange(n_marks)).tolist()
+
+
 def make_resolver(pairwise_matcher):
     """
     convert a pairwise markable matching function into a coreference resolution system, which generates antecedent lists
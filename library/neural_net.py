@@ -1,10 +1,14 @@
+import contextlib
+
 import torch
 import torch.nn as nn
-import torch.autograd as ag
 import torch.nn.functional as F
+import torch.nn.utils.rnn as rnn
+import numpy as np
 
 import library.utils as utils
 import library.coref as coref
+import library.coref_features as coref_features
 
 
 class BiLSTMWordEmbedding(nn.Module):
@@ -48,52 +52,71 @@ class BiLSTMWordEmbedding(nn.Module):
            These will be the inputs to the LSTM sequence model.
            NOTE: At this step, rather than a list of embeddings, it should be a single tensor.
         2. Now that you have your tensor of embeddings, You can pass it through your LSTM.
-        3. Convert the outputs into the correct return type, which is a list of lists of
-           embeddings, each of shape (1, hidden_dim)
+        3. Return the outputs as a single tensor; indexing it by word gives
+           embeddings of shape (1, hidden_dim)
         NOTE: Make sure you are reassigning self.hidden to the new hidden state!
         :param document: a list of strs, the words of the document
-        :returns: a list of embeddings for the document
+        :returns: the embeddings for the document
+        :rtype: Variable of dimensions len(document)x1xhidden_dim
         """
         assert self.word_to_ix is not None, "ERROR: Make sure to set word_to_ix on \
                 the embedding lookup components"
 
-        embeds = []
-
-        for word in document:
-            word_index = self.word_to_ix[word]
-            index_tensor = ag.Variable(torch.LongTensor([word_index]))
-            embedding = self.word_embeddings(index_tensor)
-            embeds.append(embedding)
+        index_tensor = torch.as_tensor(
+            [self.word_to_ix[word] for word in document],
+            dtype=torch.long,
+            device=self.word_embeddings.weight.device)
+        embeds = self.word_embeddings(index_tensor).unsqueeze(1)
 
-        embeds = torch.cat(embeds, dim=0)
+        output, _ = self.lstm.forward(embeds, self.hidden)
 
-        output, _ = self.lstm.forward(embeds.view(len(document), 1, -1),
-                                      self.hidden)
+        return output
 
-        outp = []
-        for emb in output:
-            outp.append(emb)
-
-        return outp
+    def forward_batch(self, documents):
+        """
+        Same as forward, for several documents at once.
+        The documents are packed into a single sequence batch for the LSTM.
+        :param documents: a list of documents, each a list of strs
+        :returns: a list with the embeddings for each document, as returned by forward
+        """
+        assert self.word_to_ix is not None, "ERROR: Make sure to set word_to_ix on \
+                the embedding lookup components"
 
-    def init_hidden(self):
+        device = self.word_embeddings.weight.device
+        index_tensors = [
+            torch.as_tensor([self.word_to_ix[word] for word in document],
+                            dtype=torch.long,
+                            device=device) for document in documents
+        ]
+        packed = rnn.pack_sequence(index_tensors, enforce_sorted=False)
+        embeds = rnn.PackedSequence(self.word_embeddings(packed.data),
+                                    packed.batch_sizes, packed.sorted_indices,
+                                    packed.unsorted_indices)
+
+        output, _ = self.lstm.forward(embeds,
+                                      self.init_hidden(len(documents)))
+        output, lengths = rnn.pad_packed_sequence(output)
+
+        return [
+            output[:length, b:b + 1]
+            for b, length in enumerate(lengths.tolist())
+        ]
+
+    def init_hidden(self, batch_size=1):
         """
         PyTorch wants you to supply the last hidden state at each timestep
         to the LSTM.  You shouldn't need to call this function explicitly
+        :param batch_size: number of documents run through the LSTM together
         """
-        if self.use_cuda:
-            return (ag.Variable(
-                cuda.FloatTensor(self.num_layers * 2, 1,
-                                 self.hidden_dim // 2).zero_()),
-                    ag.Variable(
-                        cuda.FloatTensor(self.num_layers * 2, 1,
-                                         self.hidden_dim // 2).zero_()))
-        else:
-            return (ag.Variable(
-                torch.zeros(self.num_layers * 2, 1, self.hidden_dim // 2)),
-                    ag.Variable(
-                        torch.zeros(self.num_layers * 2, 1,
-                                    self.hidden_dim // 2)))
+        device = 'cuda' if self.use_cuda else 'cpu'
+        return (torch.zeros(self.num_layers * 2,
+                            batch_size,
+                            self.hidden_dim // 2,
+                            device=device),
+                torch.zeros(self.num_layers * 2,
+                            batch_size,
+                            self.hidden_dim // 2,
+                            device=device))
 
     def clear_hidden_state(self):
         self.hidden = self.init_hidden()
@@ -101,6 +124,7 @@ class BiLSTMWordEmbedding(nn.Module):
     def to_cuda(self):
         self.use_cuda = True
         self.cuda()
+        self.clear_hidden_state()
 
 
 class AttentionBasedMarkableEmbedding(nn.Module):
@@ -128,12 +152,40 @@ class AttentionBasedMarkableEmbedding(nn.Module):
         :returns: attended embedding for markable (1d vector)
         """
 
-        span_embeddings = embeddings[markable.start_token:markable.end_token]
-        e = torch.cat(span_embeddings)
+        e = stack_embeddings(
+            embeddings[markable.start_token:markable.end_token])
         a = self.u(e)
         a = F.softmax(a, dim=0)
         return torch.sum(a.mul(e), dim=0)
 
+    def forward_batch(self, embeddings, markables):
+        """
+        Same as forward, for all markables of a document at once
+        :param embeddings: all embeddings for words in the document
+        :param markables: list of markables in the document
+        :returns: attended embeddings, one row per markable
+        :rtype: Variable of dimensions len(markables)xembedding_dim
+        """
+
+        e = stack_embeddings(embeddings)
+        if len(markables) == 0:
+            return e.new_zeros((0, e.shape[1]))
+
+        # pad every span to the longest one and mask out the padding
+        device = e.device
+        starts = torch.as_tensor([m.start_token for m in markables],
+                                 device=device)
+        lengths = torch.as_tensor(
+            [m.end_token - m.start_token for m in markables], device=device)
+        offsets = torch.arange(int(lengths.max()), device=device)
+        mask = offsets.unsqueeze(0) < lengths.unsqueeze(1)
+        token_idx = (starts.unsqueeze(1) + offsets.unsqueeze(0)).clamp(
+            max=e.shape[0] - 1)
+
+        a = self.u(e).squeeze(1)[token_idx]
+        a = F.softmax(a.masked_fill(~mask, float('-inf')), dim=1)
+        return torch.sum(a.unsqueeze(2).mul(e[token_idx]), dim=1)
+
     def to_cuda(self):
         self.use_cuda = True
         self.cuda()
@@ -158,6 +210,17 @@ class SequentialScorer(nn.Module):
         self.feat_emb_dim = feat_emb_dim
         self.feat_to_idx = {feat: i for i, feat in enumerate(feat_set)}
         self.idx_to_feat = {i: feat for i, feat in enumerate(feat_set)}
+        # column of each feature of feat_set in the unpacked bitmasks of
+        # coref_features.document_feature_masks; unknown features map to an
+        # extra column that is never set
+        n_known = len(coref_features.FEATURE_NAMES)
+        self.feat_mask_cols = np.array([
+            coref_features.FEATURE_INDEX.get(feat, n_known) for feat in feat_set
+        ])
+        self.feat_mask_unknown = np.array([
+            feat not in self.feat_to_idx
+            for feat in coref_features.FEATURE_NAMES
+        ])
 
         self.feat_off_embs = nn.Embedding(num_embeddings=len(feat_set),
                                           embedding_dim=feat_emb_dim)
@@ -170,6 +233,88 @@ class SequentialScorer(nn.Module):
 
         self.use_cuda = False
 
+    def feature_selector(self, pos_idx_list):
+        """
+        :param pos_idx_list: list holding the feat_set indices of the positive features of each candidate pair
+        :returns on: PxF boolean tensor, True for the positive features of each pair
+        :returns rank: PxF tensor, position of each positive feature among the positives of its pair
+        """
+        on = np.zeros((len(pos_idx_list), len(self.feat_set)), dtype=bool)
+        rank = np.zeros(on.shape, dtype=np.int64)
+        for pair, pos_idx in enumerate(pos_idx_list):
+            on[pair, pos_idx] = True
+            rank[pair, pos_idx] = np.arange(len(pos_idx))
+        return self._selector_tensors(on, rank)
+
+    def mask_feature_selector(self, masks, feature_ids=None):
+        """
+        feature_selector for pairs given as coref_features bitmasks
+        :param masks: array of P feature bitmasks
+        :param feature_ids: coref_features.feature_order of the feature function,
+            giving the order in which the positives of a pair are ranked
+        :returns on: PxF boolean tensor, True for the positive features of each pair
+        :returns rank: PxF tensor, position of each positive feature among the positives of its pair
+        """
+        n_known = len(coref_features.FEATURE_NAMES)
+        bits = np.asarray(masks, dtype=np.uint64)[:, None] >> np.arange(
+            n_known, dtype=np.uint64)
+        bits = (bits & np.uint64(1)).astype(bool)
+
+        unknown = np.flatnonzero((bits & self.feat_mask_unknown).any(axis=0))
+        if len(unknown) > 0:
+            raise KeyError(coref_features.FEATURE_NAMES[unknown[0]])
+
+        if feature_ids is None:
+            feature_ids = np.arange(n_known)
+        rank = np.zeros(bits.shape, dtype=np.int64)
+        rank[:, feature_ids] = np.cumsum(bits[:, feature_ids], axis=1) - 1
+        # pad with a column that is never set, for features outside the registry
+        bits = np.pad(bits, ((0, 0), (0, 1)))
+        rank = np.pad(rank, ((0, 0), (0, 1)))
+        return self._selector_tensors(bits[:, self.feat_mask_cols],
+                                      rank[:, self.feat_mask_cols])
+
+    def _selector_tensors(self, on, rank):
+        device = self.feat_off_embs.weight.device
+        return (torch.as_tensor(on, device=device),
+                torch.as_tensor(rank, dtype=torch.long,
+                                device=device).clamp(min=0))
+
+    def pair_feature_selector(self,
+                              markables,
+                              ment_idx,
+                              ant_idx,
+                              feats,
+                              feat_masks=None):
+        """
+        :param markables: list of all markables in the document
+        :param ment_idx: indices of the current markable of each pair
+        :param ant_idx: indices of the antecedent of each pair
+        :param feats: feature extraction function
+        :param feat_masks: coref_features.document_feature_masks for the document, if available
+        :returns: output of feature_selector for the pairs
+        """
+        if feat_masks is not None:
+            return self.mask_feature_selector(
+                feat_masks[ment_idx, ant_idx],
+                coref_features.feature_order(feats))
+        return self.feature_selector([[
+            self.feat_to_idx[k] for k, v in feats(markables, a, i).items()
+            if v > 0
+        ] for i, a in zip(ment_idx, ant_idx)])
+
+    def feature_embeddings(self, on, rank):
+        """
+        :param on: PxF boolean tensor, True for the positive features of each candidate pair
+        :param rank: PxF tensor, index of the "on" embedding used by each positive feature
+        :returns: flattened boolean feature embeddings, one row per pair
+        :rtype: Variable of dimensions Px(|feat_set|*feat_emb_dim)
+        """
+        # "off" embeddings everywhere, with the "on" rows swapped in for positives
+        feature_emb = torch.where(on.unsqueeze(2), self.feat_on_embs(rank),
+                                  self.feat_off_embs.weight)
+        return feature_emb.reshape(on.shape[0], -1)
+
     def forward(self, emb_i, emb_a, pos_feats):
         """
         :param emb_i: embedding for current markable
@@ -179,32 +324,19 @@ class SequentialScorer(nn.Module):
         :rtype: 1x1 Variable
         """
 
-        feature_emb = ag.Variable(
-            torch.zeros(len(self.feat_set), self.feat_emb_dim))
-
-        for i in range(len(self.feat_set)):
-            feature_emb[i] = self.feat_off_embs(
-                ag.Variable(torch.LongTensor([i])))
-
-        for i, feat in enumerate(pos_feats):
-            feature_emb[self.feat_to_idx[feat]] = self.feat_on_embs(
-                ag.Variable(torch.LongTensor([i])))
+        feature_emb = self.feature_embeddings(*self.feature_selector(
+            [[self.feat_to_idx[feat] for feat in pos_feats]]))
 
         # Bad Hack because ipnb has a vector instead of matrix
         if emb_i.shape[0] == 1:
-            feature_emb = feature_emb.view(
-                1,
-                len(self.feat_set) * self.feat_emb_dim)
             input = torch.cat((emb_i, emb_a, feature_emb), dim=1)
         else:
-            feature_emb = feature_emb.view(
-                len(self.feat_set) * self.feat_emb_dim)
-            input = torch.cat((emb_i, emb_a, feature_emb))
+            input = torch.cat((emb_i, emb_a, feature_emb.view(-1)))
 
         # print("input: ", input.data, pos_feats)
         return self.net(input)
 
-    def score_instance(self, doc_embs, markables, i, feats):
+    def score_instance(self, doc_embs, markables, i, feats, feat_masks=None):
         """
         A function scoring all coref candidates for a given markable
         Don't forget the new-entity option!
@@ -212,24 +344,111 @@ class SequentialScorer(nn.Module):
         :param markables: list of all markables in the document
         :param i: index of current markable
         :param feats: feature extraction function
+        :param feat_masks: coref_features.document_feature_masks for the document, if already computed;
+            otherwise feats is called on the i+1 candidates only
         :returns: list of scores for all candidates
         :rtype: torch.FloatTensor of dimensions 1x(i+1)
         """
 
-        def get_pos_feats(markables, a, i):
-            return [k for k, v in feats(markables, a, i).items() if v > 0]
-
-        scores = ag.Variable(torch.FloatTensor(1, i + 1))
-
-        for ant_index, ant in enumerate(markables[:i + 1]):
-            score_var = self.forward(doc_embs[i], doc_embs[ant_index],
-                                     get_pos_feats(markables, ant_index, i))
-            scores[0, ant_index] = score_var[0]
+        # score all i+1 candidates with a single pass through the network;
+        # the mention's share of the first layer is computed only once
+        n_cands = i + 1
+        ment_layer, ant_layer = self.embedding_layers(doc_embs[i].shape[-1])
+        hidden_i = ment_layer(doc_embs[i].view(1, -1))
+        hidden_a = ant_layer(stack_embeddings(doc_embs[:n_cands]))
+        on, rank = self.pair_feature_selector(markables, np.full(n_cands, i),
+                                              np.arange(n_cands), feats,
+                                              feat_masks)
+        return self.score_hidden(hidden_i + hidden_a, on,
+                                 rank).view(1, n_cands)
+
+    def score_document(self, doc_embs, markables, feats, feat_masks=None):
+        """
+        Score all coref candidates for every markable in the document at once
+        :param doc_embs: embeddings for markables in the document
+        :param markables: list of all markables in the document
+        :param feats: feature extraction function
+        :param feat_masks: coref_features.document_feature_masks for the document, if already computed
+        :returns: row i holds the scores of score_instance for markable i,
+                  entries after the diagonal are -inf
+        :rtype: torch.FloatTensor of dimensions len(markables)xlen(markables)
+        """
 
-        return scores
+        if feat_masks is None:
+            feat_masks = coref_features.document_feature_masks(markables, feats)
+
+        embs = stack_embeddings(doc_embs)
+        n_marks = embs.shape[0]
+        ment_idx, ant_idx = torch.tril_indices(n_marks,
+                                               n_marks,
+                                               device=embs.device)
+        on, rank = self.pair_feature_selector(markables,
+                                              ment_idx.cpu().numpy(),
+                                              ant_idx.cpu().numpy(), feats,
+                                              feat_masks)
+
+        # first-layer contributions of each markable, as mention and as antecedent
+        ment_layer, ant_layer = self.embedding_layers(embs.shape[1])
+        hidden = ment_layer(embs)[ment_idx] + ant_layer(embs)[ant_idx]
+
+        scores = embs.new_full((n_marks, n_marks), float('-inf'))
+        pair_scores = self.score_hidden(hidden, on, rank).view(-1)
+        # under autocast the pair scores may come back in lower precision
+        return scores.index_put((ment_idx, ant_idx),
+                                pair_scores.to(scores.dtype))
+
+    def embedding_layers(self, mark_embedding_dim):
+        """
+        Split the first linear layer of self.net into the blocks acting on
+        the mention embedding and on the antecedent embedding.
+        :param mark_embedding_dim: dimension of markable embeddings
+        :returns: functions giving each block's share of the first layer (without bias)
+        """
+        weight = self.net[0].weight
+        ment_weight = weight[:, :mark_embedding_dim]
+        ant_weight = weight[:, mark_embedding_dim:2 * mark_embedding_dim]
+        return (lambda embs: F.linear(embs, ment_weight),
+                lambda embs: F.linear(embs, ant_weight))
 
-    def instance_top_scores(self, doc_embs, markables, i, true_antecedent,
-                            feats):
+    def score_hidden(self, hidden, on, rank):
+        """
+        Finish self.net for pairs whose embedding share of the first layer is known.
+        The boolean feature share is split into the all-"off" baseline, shared by
+        every pair, and a correction for each positive feature, which depends
+        only on the feature and its "on" embedding and is tabulated once per call.
+        :param hidden: Pxhidden_dim embedding share of the first layer
+        :param on: PxF boolean tensor, True for the positive features of each pair
+        :param rank: PxF tensor, index of the "on" embedding used by each positive feature
+        :returns: scores
+        :rtype: Px1 Variable
+        """
+        first = self.net[0]
+        n_feats = len(self.feat_set)
+        feat_weight = first.weight[:, -n_feats * self.feat_emb_dim:].view(
+            -1, n_feats, self.feat_emb_dim)
+        off_embs = self.feat_off_embs.weight
+        on_embs = self.feat_on_embs.weight
+
+        baseline = torch.einsum('hfe,fe->h', feat_weight, off_embs) + first.bias
+        # correction[f, k] for feature f switched on with "on" embedding k
+        correction = torch.einsum(
+            'hfe,kfe->fkh', feat_weight,
+            on_embs.unsqueeze(1) - off_embs.unsqueeze(0))
+        # add up the corrections of the positive features only
+        pair_idx, feat_idx = on.nonzero(as_tuple=True)
+        positives = correction[feat_idx, rank[pair_idx, feat_idx]]
+
+        hidden = hidden + baseline
+        hidden = hidden.index_add(0, pair_idx, positives.to(hidden.dtype))
+        return self.net[2](self.net[1](hidden))
+
+    def instance_top_scores(self,
+                            doc_embs,
+                            markables,
+                            i,
+                            true_antecedent,
+                            feats,
+                            feat_masks=None):
         """
         Find the top-scoring true and false candidates for i in the markable.
         If no false candidates exist, return (None, None).
@@ -239,6 +458,7 @@ class SequentialScorer(nn.Module):
         :param i: index of current markable
         :param true_antecedent: gold label for markable
         :param feats: feature extraction function
+        :param feat_masks: coref_features.document_feature_masks for the document, if already computed
         :returns trues_max: best-scoring true antecedent
         :returns false_max: best-scoring false antecedent
         """
@@ -246,30 +466,88 @@ class SequentialScorer(nn.Module):
         if i == 0 or i == true_antecedent:
             return None, None
         else:
-            scores = self.score_instance(doc_embs, markables, i, feats)
-
-            all_trues_indices = torch.LongTensor([
-                index for index in range(0, i)
-                if markables[index].entity == markables[true_antecedent].entity
-            ])
-            all_false_indices = torch.LongTensor([
-                index for index in range(0, i)
-                if markables[index].entity != markables[true_antecedent].entity
-            ])
-
-            if all_trues_indices.shape[0] == i:
+            true_entity = markables[true_antecedent].entity
+            true_mask = torch.as_tensor(
+                [m.entity == true_entity for m in markables[:i]],
+                device=self.net[0].weight.device)
+
+            if true_mask.all():
                 return None, None
 
-            zero_tensor = torch.LongTensor([0])
-            trues_max_val = torch.max(scores[zero_tensor, all_trues_indices])
-            false_max_val = torch.max(scores[zero_tensor, all_false_indices])
+            scores = self.score_instance(doc_embs, markables, i, feats,
+                                         feat_masks)
+            earlier_scores = scores[0, :i]
+            trues_max_val = earlier_scores.masked_select(true_mask).max()
+            false_max_val = earlier_scores.masked_select(~true_mask).max()
             return trues_max_val, false_max_val
 
+    def document_top_scores(self,
+                            doc_embs,
+                            markables,
+                            feats,
+                            feat_masks=None,
+                            mark_set=None):
+        """
+        instance_top_scores for every markable of the document at once,
+        from a single call to score_document.
+        Markables for which instance_top_scores returns (None, None) are left out.
+        :param doc_embs: embeddings for markables in the document
+        :param markables: list of all markables in the document
+        :param feats: feature extraction function
+        :param feat_masks: coref_features.document_feature_masks for the document, if already computed
+        :param mark_set: coref.to_markable_set for the document, if already computed
+        :returns trues_max: best-scoring true antecedents
+        :returns false_max: best-scoring false antecedents
+        """
+
+        if mark_set is None:
+            mark_set = coref.to_markable_set(markables)
+        if feat_masks is None:
+            feat_masks = coref_features.document_feature_masks(
+                markables, feats, mark_set)
+        scores = self.score_document(doc_embs, markables, feats, feat_masks)
+
+        entities = mark_set.entities
+        earlier = np.tri(len(markables), k=-1, dtype=bool)
+        same_entity = entities[:, None] == entities[None, :]
+        true_mask = torch.as_tensor(earlier & same_entity,
+                                    device=scores.device)
+        false_mask = torch.as_tensor(earlier & ~same_entity,
+                                     device=scores.device)
+        has_both = true_mask.any(dim=1) & false_mask.any(dim=1)
+
+        trues_max = scores.masked_fill(~true_mask, float('-inf')).max(dim=1)[0]
+        false_max = scores.masked_fill(~false_mask,
+                                       float('-inf')).max(dim=1)[0]
+        return trues_max[has_both], false_max[has_both]
+
     def to_cuda(self):
         self.use_cuda = True
         self.cuda()
 
 
+def stack_embeddings(doc_embs):
+    """
+    :param doc_embs: list of embeddings, or a tensor indexed by its first dimension
+    :returns: tensor with one row per embedding
+    """
+    if torch.is_tensor(doc_embs):
+        return doc_embs.flatten(1)
+    return torch.stack([emb.view(-1) for emb in doc_embs])
+
+
+@contextlib.contextmanager
+def inference_context(use_cuda):
+    """
+    Context for running the models without autograd;
+    on the GPU, it also runs them in bfloat16 autocast.
+    """
+    with torch.inference_mode(), torch.autocast(device_type='cuda',
+                                                dtype=torch.bfloat16,
+                                                enabled=use_cuda):
+        yield
+
+
 def train(doc_lstm_model,
           attn_model,
           scoring_model,
@@ -280,11 +558,9 @@ def train(doc_lstm_model,
           word_limit,
           epochs=2,
           margin=1.0,
-          use_cuda=False):
-    if not use_cuda:
-        _zero = ag.Variable(torch.Tensor([0]))
-    else:
-        _zero = ag.Variable(torch.cuda.FloatTensor([0]))
+          use_cuda=False,
+          batch_size=1):
+    if use_cuda:
         doc_lstm_model.to_cuda()
         attn_model.to_cuda()
         scoring_model.to_cuda()
@@ -292,36 +568,30 @@ def train(doc_lstm_model,
         tot_loss = 0.0
         instances = 0
         doc_losses = []
-        for words, marks in zip(words_set, markable_set):
-            words = words[:word_limit]
-            marks = [m for m in marks if m.end_token < word_limit]
+        docs = list(zip(words_set, markable_set))
+        for batch_start in range(0, len(docs), batch_size):
+            batch = [(words[:word_limit],
+                      [m for m in marks if m.end_token < word_limit])
+                     for words, marks in docs[batch_start:batch_start +
+                                              batch_size]]
             optimizer.zero_grad()
-            doc_lstm_model.clear_hidden_state()
 
-            if not use_cuda:
-                loss = ag.Variable(torch.FloatTensor([0.0]))
-            else:
-                loss = ag.Variable(torch.cuda.FloatTensor([0.0]))
-
-            base_embs = doc_lstm_model(words)
-            att_embs = [attn_model(base_embs, m) for m in marks]
-            true_ants = coref.get_true_antecedents(marks)
-            for i in range(len(marks)):
-                max_t, max_f = scoring_model.instance_top_scores(
-                    att_embs, marks, i, true_ants[i], feats)
-                if max_t is None: continue
-
-                if not use_cuda:
-                    marg = ag.Variable(torch.Tensor([margin])) - max_t + max_f
-                else:
-                    marg = ag.Variable(torch.cuda.FloatTensor(
-                        [margin])) - max_t + max_f
-
-                loss += torch.max(torch.cat((_zero, marg)))
-            instances += len(marks)
-            sc_loss = utils.to_scalar(loss)
-            tot_loss += sc_loss
-            doc_losses.append(f'{sc_loss / len(marks):.5f}')
+            batch_embs = doc_lstm_model.forward_batch(
+                [words for words, _ in batch])
+            loss = 0
+            for base_embs, (_, marks) in zip(batch_embs, batch):
+                att_embs = attn_model.forward_batch(base_embs, marks)
+                mark_set = coref.to_markable_set(marks)
+                feat_masks = coref_features.document_feature_masks(
+                    marks, feats, mark_set)
+                max_t, max_f = scoring_model.document_top_scores(
+                    att_embs, marks, feats, feat_masks, mark_set)
+                doc_loss = F.relu(margin - max_t + max_f).sum()
+                instances += len(marks)
+                sc_loss = utils.to_scalar(doc_loss)
+                tot_loss += sc_loss
+                doc_losses.append(f'{sc_loss / len(marks):.5f}')
+                loss = loss + doc_loss
             loss.backward()
             optimizer.step()
         print(
@@ -336,11 +606,14 @@ def evaluate(doc_lstm_model, attn_model, scoring_model, words_set,
     attn_model.eval()
     scoring_model.eval()
     emb_dict = {}  # for getting around matcher's signature
-    for words, marks in zip(words_set, markable_set):
-        doc_lstm_model.clear_hidden_state()
-        base_embs = doc_lstm_model(words)
-        att_embs = [attn_model(base_embs, m) for m in marks]
-        emb_dict[marks[0].entity] = att_embs
+    with inference_context(scoring_model.use_cuda):
+        for words, marks in zip(words_set, markable_set):
+            doc_lstm_model.clear_hidden_state()
+            base_embs = doc_lstm_model(words)
+            att_embs = attn_model.forward_batch(base_embs, marks)
+            emb_dict[marks[0].entity] = att_embs.float()
+    # the hidden state created above is an inference tensor, unusable for training
+    doc_lstm_model.clear_hidden_state()
     resolver = make_resolver(feats, emb_dict, scoring_model)
     coref.eval_on_dataset(resolver, markable_set)
     return resolver
@@ -348,6 +621,12 @@ def evaluate(doc_lstm_model, attn_model, scoring_model, words_set,
 
 # helper
 def make_resolver(feats, emb_dict, scoring_model):
-    return lambda markables: [
-        utils.argmax(scoring_model.score_instance(emb_dict[markables[0].entity], markables, i, feats)) \
-        for i in range(len(markables))]
\ No newline at end of file
+
+    def resolver(markables):
+        doc_embs = emb_dict[markables[0].entity]
+        with inference_context(scoring_model.use_cuda):
+            # row i scores the candidates of markable i, and is -inf past i
+            scores = scoring_model.score_document(doc_embs, markables, feats)
+            return scores.argmax(dim=1).tolist()
+
+    return resolver
\ No newline at end of file
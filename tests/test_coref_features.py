@@ -0,0 +1,45 @@
+import os
+from collections import defaultdict
+
+from library import coref, coref_features
+
+TRAIN_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'wsj',
+                         'train')
+
+
+def read_tagged(page_name):
+    markables, _ = coref.read_data(page_name, basedir=TRAIN_DIR)
+    # the files carry no POS tags; make up some so that content matching
+    # depends on more than the span offsets
+    return [
+        m._replace(tags=['NN' if len(tok) > 3 else 'DT' for tok in m.string])
+        for m in markables
+    ]
+
+
+def generic_union(feat_func_list):
+    def union_func(x, a, i):
+        f = defaultdict(float)
+        for feat_func in feat_func_list:
+            f.update(feat_func(x, a, i))
+        return f
+
+    return union_func
+
+
+def test_fused_union_matches_generic_union():
+    minimal, distance = (coref_features.minimal_features,
+                         coref_features.distance_features)
+    for page_name in ['01_wsj_0007.sty', '02_wsj_0011.sty', '03_wsj_0092.sty']:
+        markables = read_tagged(page_name)
+        for feat_func_list in [[minimal, distance], [distance, minimal]]:
+            fused = coref_features.make_feature_union(feat_func_list)
+            generic = generic_union(feat_func_list)
+            masks = coref_features.document_feature_masks(markables, fused)
+            for i in range(len(markables)):
+                for a in range(i + 1):
+                    expected = list(generic(markables, a, i).items())
+                    assert list(fused(markables, a, i).items()) == expected
+                    assert sorted(
+                        coref_features.mask_to_features(
+                            masks[i, a]).items()) == sorted(expected)
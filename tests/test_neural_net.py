@@ -0,0 +1,28 @@
+import os
+
+import torch
+
+from library import coref, coref_features, neural_net
+
+TRAIN_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'wsj',
+                         'train')
+
+
+def test_score_document_under_autocast():
+    markables, _ = coref.read_data('01_wsj_0007.sty', basedir=TRAIN_DIR)
+    torch.manual_seed(0)
+    scorer = neural_net.SequentialScorer(8, coref_features.MINIMAL_FEATURES,
+                                         3, 6)
+    embs = torch.randn(len(markables), 8)
+    expected = scorer.score_document(embs, markables,
+                                     coref_features.minimal_features)
+
+    with torch.inference_mode(), torch.autocast(device_type='cpu',
+                                                dtype=torch.bfloat16):
+        scores = scorer.score_document(embs, markables,
+                                       coref_features.minimal_features)
+
+    assert scores.dtype == expected.dtype
+    finite = torch.isfinite(expected)
+    assert torch.equal(torch.isfinite(scores), finite)
+    assert torch.allclose(scores[finite], expected[finite], atol=0.05)